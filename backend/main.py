@@ -7,6 +7,12 @@ import os
 from typing import List, Optional, Dict
 from datetime import datetime
 import re
+import math
+import time
+import random
+import hashlib
+import contextvars
+from array import array
 import openai
 from typing import Dict, List
 from fastapi.responses import StreamingResponse
@@ -24,8 +30,190 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Upstream-Stale"],
 )
 
+# Resiliens för anrop till GitHub och Asana
+UPSTREAM_BUDGET_SECONDS = float(os.getenv("UPSTREAM_BUDGET_SECONDS", "20"))  # Total tidsbudget per inkommande request
+UPSTREAM_ATTEMPT_TIMEOUT = float(os.getenv("UPSTREAM_ATTEMPT_TIMEOUT", "4"))  # Max tid per enskilt försök
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+UPSTREAM_HEDGE_DELAY = float(os.getenv("UPSTREAM_HEDGE_DELAY", "0"))  # 0 = inga hedgade requests
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_OPEN_SECONDS = 30
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+RATE_LIMITED_STATUS_CODE = 429  # Gäller en token, inte hela hosten, så den påverkar inte circuit breakern
+LAST_KNOWN_GOOD_MAX = 1000
+
+# Deadline och stale-flagga för den aktuella requesten, sätts av middleware nedan
+request_budget: contextvars.ContextVar[Optional[Dict]] = contextvars.ContextVar("request_budget", default=None)
+circuit_breakers: Dict[str, Dict] = {}  # host -> {"failures", "opened_at", "probing"}
+last_known_good: Dict[str, Dict] = {}  # cache-nyckel -> senaste lyckade svar
+
+@app.middleware("http")
+async def upstream_budget_middleware(request, call_next):
+    """Ge varje request en deadline som alla upstream-anrop delar på"""
+    budget = {"deadline": time.monotonic() + UPSTREAM_BUDGET_SECONDS, "stale": False}
+    request_budget.set(budget)
+    response = await call_next(request)
+    if budget["stale"]:
+        # Frontend kan visa att datan kommer från cache
+        response.headers["X-Upstream-Stale"] = "1"
+    return response
+
+def remaining_budget() -> float:
+    """Sekunder kvar av den aktuella requestens budget"""
+    budget = request_budget.get()
+    if budget is None:
+        return UPSTREAM_BUDGET_SECONDS
+    return budget["deadline"] - time.monotonic()
+
+def breaker_allows(host: str) -> bool:
+    """Kolla om circuit breakern för en host släpper igenom anrop"""
+    breaker = circuit_breakers.get(host)
+    if not breaker or breaker["opened_at"] is None:
+        return True
+    if time.monotonic() - breaker["opened_at"] < BREAKER_OPEN_SECONDS:
+        return False
+    # Half-open: släpp igenom ett testanrop i taget
+    if breaker["probing"]:
+        return False
+    breaker["probing"] = True
+    return True
+
+def record_upstream_result(host: str, success: bool):
+    """Uppdatera circuit breakern efter ett anrop (probing släpps bara av anropet som äger testanropet)"""
+    breaker = circuit_breakers.setdefault(host, {"failures": 0, "opened_at": None, "probing": False})
+    if success:
+        breaker["failures"] = 0
+        breaker["opened_at"] = None
+        return
+    breaker["failures"] += 1
+    if breaker["opened_at"] is not None or breaker["failures"] >= BREAKER_FAILURE_THRESHOLD:
+        breaker["opened_at"] = time.monotonic()
+        print(f"Circuit breaker öppen för {host}")
+
+def serve_last_known_good(cache_key: str) -> Optional[httpx.Response]:
+    """Hämta senaste lyckade svar från cache och markera requesten som stale"""
+    cached = last_known_good.get(cache_key)
+    if not cached:
+        return None
+    budget = request_budget.get()
+    if budget is not None:
+        budget["stale"] = True
+    return httpx.Response(cached["status_code"], content=cached["content"], headers=cached["headers"])
+
+async def hedged_get(client: httpx.AsyncClient, url: str, timeout: float, **kwargs) -> httpx.Response:
+    """GET som startar ett extra parallellt anrop om det första dröjer, första lyckade svaret vinner"""
+    tasks = {asyncio.create_task(client.get(url, timeout=timeout, **kwargs))}
+    error = None
+    retryable_response = None
+    try:
+        if 0 < UPSTREAM_HEDGE_DELAY < timeout:
+            done, _ = await asyncio.wait(tasks, timeout=UPSTREAM_HEDGE_DELAY)
+            if not done:
+                tasks.add(asyncio.create_task(client.get(url, timeout=timeout - UPSTREAM_HEDGE_DELAY, **kwargs)))
+
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            # Gå igenom alla klara tasks så att inga exceptions lämnas ohämtade
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif task.result().status_code in RETRYABLE_STATUS_CODES:
+                    retryable_response = task.result()
+                elif winner is None:
+                    winner = task.result()
+            if winner is not None:
+                return winner
+        if retryable_response is not None:
+            return retryable_response
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def upstream_get(
+    client: httpx.AsyncClient,
+    url: str,
+    headers: Optional[Dict] = None,
+    params: Optional[Dict] = None
+) -> httpx.Response:
+    """GET mot GitHub/Asana med deadline, retries med jitter, circuit breaker och last-known-good cache"""
+    host = httpx.URL(url).host
+    cache_key = json.dumps([url, params or {}, token_fingerprint((headers or {}).get("Authorization", ""))], sort_keys=True)
+
+    # Kolla budgeten innan breakern så att vi inte tar ett half-open testanrop vi ändå inte hinner göra
+    if remaining_budget() <= 0:
+        cached = serve_last_known_good(cache_key)
+        if cached is None:
+            raise HTTPException(status_code=504, detail=f"Timeout mot {host}")
+        return cached
+
+    was_probing = circuit_breakers.get(host, {}).get("probing", False)
+    if not breaker_allows(host):
+        cached = serve_last_known_good(cache_key)
+        if cached is None:
+            raise HTTPException(status_code=503, detail=f"{host} svarar inte just nu, försök igen senare")
+        return cached
+    owns_probe = not was_probing and circuit_breakers.get(host, {}).get("probing", False)
+
+    response = None
+    try:
+        for attempt in range(UPSTREAM_MAX_RETRIES + 1):
+            remaining = remaining_budget()
+            if remaining <= 0:
+                break
+
+            # httpx timeout gäller per fas (connect/read/...), wait_for ger en riktig total gräns per försök
+            attempt_timeout = min(remaining, UPSTREAM_ATTEMPT_TIMEOUT)
+            try:
+                response = await asyncio.wait_for(
+                    hedged_get(client, url, attempt_timeout, headers=headers, params=params),
+                    timeout=attempt_timeout
+                )
+            except (httpx.HTTPError, asyncio.TimeoutError) as e:
+                print(f"Upstream error for {url}: {e!r}")
+                response = None
+
+            if response is not None and response.status_code not in RETRYABLE_STATUS_CODES:
+                record_upstream_result(host, True)
+                if response.status_code == 200:
+                    if len(last_known_good) >= LAST_KNOWN_GOOD_MAX:
+                        last_known_good.pop(next(iter(last_known_good)))
+                    last_known_good[cache_key] = {
+                        "status_code": response.status_code,
+                        "content": response.content,
+                        "headers": {"content-type": response.headers.get("content-type", "application/json")}
+                    }
+                return response
+
+            if attempt == UPSTREAM_MAX_RETRIES:
+                break
+
+            # Exponentiell backoff med full jitter, men aldrig längre än budgeten räcker
+            retry_after = response.headers.get("Retry-After") if response is not None else None
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else random.uniform(0, 0.25 * 2 ** attempt)
+            if delay >= remaining_budget():
+                break
+            await asyncio.sleep(delay)
+
+        # Ett resultat per anrop (inte per försök), och rate limiting räknas inte som att hosten är nere
+        if response is None or response.status_code != RATE_LIMITED_STATUS_CODE:
+            record_upstream_result(host, False)
+    finally:
+        # Släpp testanropet även om vi avbröts (t.ex. klienten kopplade ner) innan ett resultat registrerades
+        if owns_probe:
+            circuit_breakers[host]["probing"] = False
+
+    # Alla försök misslyckades, använd cache om den finns annars låt endpointen hantera felsvaret
+    cached = serve_last_known_good(cache_key)
+    if cached is not None:
+        return cached
+    if response is None:
+        raise HTTPException(status_code=504, detail=f"Timeout mot {host}")
+    return response
+
 # Filvägar
 FAVORITES_FILE = "favorites.json"
 REPOS_FILE = "saved_repos.json"
@@ -68,6 +256,298 @@ def parse_github_url(url: str) -> Dict[str, str]:
     
     raise ValueError("Invalid GitHub URL format")
 
+# Sökindex (inverterat index över PR-titlar, PR-beskrivningar och commit-meddelanden)
+# Uppdateras inkrementellt varje gång backend hämtar PRs eller commits från GitHub, fylls på i bakgrunden
+# för alla sparade repos och sparas till fil så att det överlever omstarter.
+SEARCH_INDEX_FILE = "search_index.json"
+SEARCH_INDEX_SAVE_INTERVAL = 60  # Sekunder mellan sparningar av indexet
+SEARCH_BACKFILL_INTERVAL = 3600  # Sekunder innan samma repo fylls på igen för samma token
+SEARCH_BACKFILL_PAGES = 5  # Max antal sidor (à 100) PRs respektive commits per repo
+SEARCH_BACKFILL_BUDGET_SECONDS = 300
+SEARCH_POSTINGS: Dict[str, Dict[str, int]] = {}  # term -> {doc_id: antal förekomster}
+SEARCH_DOCS: Dict[str, Dict] = {}  # doc_id -> metadata + text + termer
+SEARCH_TOTAL_LENGTH = 0
+search_index_dirty = False
+search_backfilled: Dict[tuple, float] = {}  # (token hash, repo) -> tidpunkt för senaste påfyllning
+search_backfill_tasks = set()
+search_index_saver = None
+
+# Fäll ihop å/ä/ö m.fl. så att "forbattring" hittar "förbättring"
+SEARCH_CHAR_FOLD = str.maketrans({"å": "a", "ä": "a", "ö": "o", "æ": "a", "ø": "o", "é": "e", "è": "e", "ü": "u"})
+# Vanliga böjningsändelser (svenska + engelska), längsta först. Engelsk plural (s/es/ies) hanteras separat.
+SEARCH_SUFFIXES = (
+    "ingarna", "ingar", "ingen", "arna", "erna", "orna", "ande", "ende",
+    "ing", "ade", "ar", "er", "or", "en", "et", "at", "ad", "ed", "a"
+)
+SEARCH_SIBILANTS = ("s", "x", "z", "ch", "sh")
+SEARCH_MIN_STEM = 3
+SEARCH_STOPWORDS = {
+    "the", "a", "an", "and", "or", "of", "to", "in", "on", "for", "with", "is",
+    "och", "att", "i", "pa", "av", "for", "med", "som", "en", "ett", "det", "den", "till"
+}
+
+def strip_plural(word: str) -> str:
+    """Ta bort engelsk plural-/verbändelse s, es (efter s/x/z/ch/sh) och ies"""
+    if word.endswith("ies") and len(word) - 3 >= SEARCH_MIN_STEM:
+        return word[:-3] + "y"
+    if word.endswith("es") and len(word) - 2 >= SEARCH_MIN_STEM and word[:-2].endswith(SEARCH_SIBILANTS):
+        return word[:-2]
+    if word.endswith("s") and not word.endswith("ss") and len(word) - 1 >= SEARCH_MIN_STEM:
+        return word[:-1]
+    return word
+
+def normalize_search_term(word: str) -> str:
+    """Normalisera ett ord: gemener, fäll ihop diakritiska tecken och ta bort vanliga ändelser"""
+    word = strip_plural(word.casefold().translate(SEARCH_CHAR_FOLD))
+    # En enda ändelse tas bort, så att t.ex. "released" och "releases" båda blir "releas"
+    for suffix in SEARCH_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= SEARCH_MIN_STEM:
+            return word[:-len(suffix)]
+    # Utan ändelse tas ett avslutande "e" bort så att "release" också blir "releas"
+    if word.endswith("e") and len(word) - 1 >= SEARCH_MIN_STEM:
+        return word[:-1]
+    return word
+
+def tokenize_search_text(text: str) -> List[str]:
+    """Dela upp text i normaliserade söktermer"""
+    terms = []
+    for word in re.findall(r"\w+", text or ""):
+        folded = word.casefold().translate(SEARCH_CHAR_FOLD)
+        if folded in SEARCH_STOPWORDS:
+            continue
+        terms.append(normalize_search_term(word))
+    return terms
+
+def token_fingerprint(authorization: str) -> str:
+    """Hash av en token så att vi kan knyta data till den utan att spara själva token"""
+    return hashlib.sha256(authorization.encode()).hexdigest()
+
+def index_search_document(doc_id: str, text: str, metadata: Dict, authorization: str):
+    """Lägg till eller uppdatera ett dokument i sökindexet"""
+    global search_index_dirty
+    # Dokumentet får bara sökas fram med tokens som faktiskt har hämtat det
+    previous = SEARCH_DOCS.get(doc_id)
+    tokens = (previous["tokens"] if previous else set()) | {token_fingerprint(authorization)}
+    add_search_document(doc_id, text, metadata, tokens)
+    search_index_dirty = True
+
+def add_search_document(doc_id: str, text: str, metadata: Dict, tokens: set):
+    """Indexera text för ett dokument, ersätter tidigare version"""
+    global SEARCH_TOTAL_LENGTH
+    remove_search_document(doc_id)
+
+    term_counts: Dict[str, int] = {}
+    terms = tokenize_search_text(text)
+    for term in terms:
+        term_counts[term] = term_counts.get(term, 0) + 1
+
+    for term, count in term_counts.items():
+        SEARCH_POSTINGS.setdefault(term, {})[doc_id] = count
+
+    SEARCH_DOCS[doc_id] = {**metadata, "text": text, "length": len(terms), "terms": list(term_counts), "tokens": tokens}
+    SEARCH_TOTAL_LENGTH += len(terms)
+
+def remove_search_document(doc_id: str):
+    """Ta bort ett dokument ur sökindexet"""
+    global SEARCH_TOTAL_LENGTH
+    doc = SEARCH_DOCS.pop(doc_id, None)
+    if not doc:
+        return
+
+    for term in doc["terms"]:
+        postings = SEARCH_POSTINGS.get(term)
+        if postings is None:
+            continue
+        postings.pop(doc_id, None)
+        if not postings:
+            del SEARCH_POSTINGS[term]
+    SEARCH_TOTAL_LENGTH -= doc["length"]
+
+SEARCH_INTERNAL_FIELDS = ("text", "length", "terms", "tokens")
+
+def save_search_index():
+    """Spara sökindexet till fil (råtext sparas så att termerna byggs om med aktuell normalisering)"""
+    global search_index_dirty
+    save_json_file(SEARCH_INDEX_FILE, {
+        doc_id: {
+            "metadata": {k: v for k, v in doc.items() if k not in SEARCH_INTERNAL_FIELDS},
+            "text": doc["text"],
+            "tokens": sorted(doc["tokens"])
+        }
+        for doc_id, doc in SEARCH_DOCS.items()
+    })
+    search_index_dirty = False
+
+def load_search_index():
+    """Ladda sökindexet från fil (körs vid startup)"""
+    try:
+        saved = load_json_file(SEARCH_INDEX_FILE, {})
+    except json.JSONDecodeError:
+        print(f"Kunde inte läsa {SEARCH_INDEX_FILE}, börjar med tomt sökindex")
+        return
+    for doc_id, doc in saved.items():
+        add_search_document(doc_id, doc["text"], doc["metadata"], set(doc["tokens"]))
+
+async def save_search_index_periodically():
+    """Spara sökindexet med jämna mellanrum om det har ändrats"""
+    while True:
+        await asyncio.sleep(SEARCH_INDEX_SAVE_INTERVAL)
+        if search_index_dirty:
+            save_search_index()
+
+def schedule_search_backfill(authorization: str):
+    """Starta bakgrundspåfyllning av sökindexet för alla sparade repos som token inte har fyllt på nyligen"""
+    token_hash = token_fingerprint(authorization)
+    now = time.monotonic()
+    repos = []
+    for repo_url in load_json_file(REPOS_FILE, []):
+        try:
+            full_name = parse_github_url(repo_url)["full_name"]
+        except ValueError:
+            continue
+        last_run = search_backfilled.get((token_hash, full_name))
+        if last_run is None or now - last_run > SEARCH_BACKFILL_INTERVAL:
+            search_backfilled[(token_hash, full_name)] = now
+            repos.append(full_name)
+
+    if repos:
+        task = asyncio.create_task(backfill_search_index(authorization, repos))
+        search_backfill_tasks.add(task)
+        task.add_done_callback(search_backfill_tasks.discard)
+
+async def backfill_search_index(authorization: str, repos: List[str]):
+    """Hämta PRs och commits för repos och lägg in dem i sökindexet"""
+    # Egen budget, bakgrundsjobbet ska inte ärva deadline från requesten som startade det
+    request_budget.set({"deadline": time.monotonic() + SEARCH_BACKFILL_BUDGET_SECONDS, "stale": False})
+    headers = {
+        "Authorization": authorization,
+        "Accept": "application/vnd.github.v3+json"
+    }
+
+    async with httpx.AsyncClient() as client:
+        for full_name in repos:
+            try:
+                for kind, params in (("pulls", {"state": "all"}), ("commits", {})):
+                    for page in range(1, SEARCH_BACKFILL_PAGES + 1):
+                        response = await upstream_get(client,
+                            f"https://api.github.com/repos/{full_name}/{kind}",
+                            headers=headers,
+                            params={**params, "per_page": 100, "page": page}
+                        )
+                        if response.status_code != 200:
+                            raise HTTPException(status_code=response.status_code, detail=f"Kunde inte hämta {kind}")
+
+                        items = response.json()
+                        for item in items:
+                            if kind == "pulls":
+                                index_pull_request(full_name, item, authorization)
+                            else:
+                                index_commit(full_name, item, authorization)
+                        if len(items) < 100:
+                            break
+            except HTTPException as e:
+                # Försök igen nästa gång påfyllning triggas
+                print(f"Kunde inte fylla på sökindex för {full_name}: {e.detail}")
+                search_backfilled.pop((token_fingerprint(authorization), full_name), None)
+
+    save_search_index()
+
+def index_pull_request(full_name: str, pr: Dict, authorization: str):
+    """Indexera en PR (titel + beskrivning) från GitHubs API-svar"""
+    index_search_document(
+        f"pr:{full_name}#{pr['number']}",
+        f"{pr.get('title') or ''}\n{pr.get('body') or ''}",
+        {
+            "type": "pull_request",
+            "repo": full_name,
+            "number": pr["number"],
+            "title": pr.get("title"),
+            "author": (pr.get("user") or {}).get("login"),
+            "date": pr.get("created_at"),
+            "url": pr.get("html_url")
+        },
+        authorization
+    )
+
+def index_commit(full_name: str, commit: Dict, authorization: str):
+    """Indexera en commit från GitHubs API-svar"""
+    message = commit["commit"]["message"]
+    index_search_document(
+        f"commit:{full_name}@{commit['sha']}",
+        message,
+        {
+            "type": "commit",
+            "repo": full_name,
+            "sha": commit["sha"],
+            "title": message.split('\n')[0],
+            "author": commit["commit"]["author"]["name"],
+            "author_login": (commit.get("author") or {}).get("login"),
+            "date": commit["commit"]["author"]["date"],
+            "url": commit.get("html_url")
+        },
+        authorization
+    )
+
+def search_index(
+    query: str,
+    authorization: str,
+    author: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    repo: Optional[str] = None,
+    limit: int = 20
+) -> List[Dict]:
+    """Rankad sökning (BM25) bland dokument hämtade med given token, med filter på författare, datum och repo"""
+    query_terms = set(tokenize_search_text(query))
+    if not query_terms or not SEARCH_DOCS:
+        return []
+
+    k1, b = 1.2, 0.75
+    doc_count = len(SEARCH_DOCS)
+    avg_length = SEARCH_TOTAL_LENGTH / doc_count or 1
+    author_filter = author.casefold() if author else None
+    token_hash = token_fingerprint(authorization)
+    # Ett rent datum som "until" ska inkludera hela dagen
+    if until and len(until) == 10:
+        until = f"{until}T23:59:59Z"
+
+    scores: Dict[str, float] = {}
+    for term in query_terms:
+        postings = SEARCH_POSTINGS.get(term)
+        if not postings:
+            continue
+        idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+        for doc_id, tf in postings.items():
+            doc = SEARCH_DOCS[doc_id]
+            norm = tf * (k1 + 1) / (tf + k1 * (1 - b + b * doc["length"] / avg_length))
+            scores[doc_id] = scores.get(doc_id, 0.0) + idf * norm
+
+    results = []
+    for doc_id, score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+        doc = SEARCH_DOCS[doc_id]
+        if token_hash not in doc["tokens"]:
+            continue
+        if repo and doc["repo"].casefold() != repo.casefold():
+            continue
+        if author_filter and author_filter not in {
+            (doc.get("author") or "").casefold(),
+            (doc.get("author_login") or "").casefold()
+        }:
+            continue
+        # ISO 8601-datum från GitHub går att jämföra som strängar
+        if since and (doc.get("date") or "") < since:
+            continue
+        if until and (doc.get("date") or "") > until:
+            continue
+
+        result = {k: v for k, v in doc.items() if k not in SEARCH_INTERNAL_FIELDS}
+        result["score"] = round(score, 4)
+        results.append(result)
+        if len(results) >= limit:
+            break
+
+    return results
+
 # Global variabel för AI prompt (laddas en gång)
 AI_PROMPT = None
 
@@ -82,13 +562,20 @@ def load_ai_prompt():
 
 @app.on_event("startup")
 async def startup_event():
-    global async_openai_client
+    global async_openai_client, search_index_saver
     load_ai_prompt()
+    load_search_index()
+    search_index_saver = asyncio.create_task(save_search_index_periodically())
     # Sätt OpenAI API key från env
     api_key = os.getenv("OPENAI_API_KEY")
     if api_key:
         async_openai_client = AsyncOpenAI(api_key=api_key)
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    if search_index_dirty:
+        save_search_index()
+
 @app.get("/api/saved-repos")
 async def get_saved_repos(authorization: Optional[str] = Header(None)):
     """Hämta sparade repositories med metadata"""
@@ -108,12 +595,15 @@ async def get_saved_repos(authorization: Optional[str] = Header(None)):
             try:
                 parsed = parse_github_url(repo_url)
                 # Hämta repo metadata från GitHub
-                response = await client.get(
-                    f"https://api.github.com/repos/{parsed['full_name']}",
-                    headers=headers
-                )
+                try:
+                    response = await upstream_get(client,
+                        f"https://api.github.com/repos/{parsed['full_name']}",
+                        headers=headers
+                    )
+                except HTTPException:
+                    response = None
                 
-                if response.status_code == 200:
+                if response is not None and response.status_code == 200:
                     repo_data = response.json()
                     repos_with_metadata.append({
                         "id": repo_data["id"],
@@ -146,6 +636,9 @@ async def get_saved_repos(authorization: Optional[str] = Header(None)):
     for repo in repos_with_metadata:
         repo['is_favorite'] = str(repo['id']) in [str(f) for f in favorites]
     
+    # Fyll på sökindexet för alla sparade repos med användarens token
+    schedule_search_backfill(authorization)
+    
     return repos_with_metadata
 
 @app.post("/api/saved-repos")
@@ -192,7 +685,7 @@ async def get_pull_requests(owner: str, repo: str, authorization: Optional[str]
     }
     
     async with httpx.AsyncClient() as client:
-        response = await client.get(
+        response = await upstream_get(client,
             f"https://api.github.com/repos/{owner}/{repo}/pulls",
             headers=headers,
             params={"state": "all", "per_page": 50, "sort": "created", "direction": "desc"}
@@ -206,6 +699,7 @@ async def get_pull_requests(owner: str, repo: str, authorization: Optional[str]
         # Berika PRs med ytterligare information
         enriched_prs = []
         for pr in prs:
+            index_pull_request(f"{owner}/{repo}", pr, authorization)
             enriched_pr = {
                 **pr,
                 "merge_commit_sha": pr.get("merge_commit_sha"),
@@ -229,7 +723,7 @@ async def get_pr_commits(owner: str, repo: str, pull_number: int, authorization:
     
     async with httpx.AsyncClient() as client:
         # Hämta PR info först
-        pr_response = await client.get(
+        pr_response = await upstream_get(client,
             f"https://api.github.com/repos/{owner}/{repo}/pulls/{pull_number}",
             headers=headers
         )
@@ -240,7 +734,7 @@ async def get_pr_commits(owner: str, repo: str, pull_number: int, authorization:
         pr_data = pr_response.json()
         
         # Hämta commits
-        commits_response = await client.get(
+        commits_response = await upstream_get(client,
             f"https://api.github.com/repos/{owner}/{repo}/pulls/{pull_number}/commits",
             headers=headers
         )
@@ -249,10 +743,12 @@ async def get_pr_commits(owner: str, repo: str, pull_number: int, authorization:
             raise HTTPException(status_code=commits_response.status_code, detail="Kunde inte hämta commits")
         
         commits = commits_response.json()
+        index_pull_request(f"{owner}/{repo}", pr_data, authorization)
         
         # Formatera commit-data
         formatted_commits = []
         for commit in commits:
+            index_commit(f"{owner}/{repo}", commit, authorization)
             formatted_commits.append({
                 "sha": commit["sha"][:7],  # Kort SHA
                 "message": commit["commit"]["message"].split('\n')[0],  # Första raden
@@ -305,7 +801,7 @@ async def get_asana_user(asana_token: Optional[str] = Header(None)):
     }
     
     async with httpx.AsyncClient() as client:
-        response = await client.get(
+        response = await upstream_get(client,
             "https://app.asana.com/api/1.0/users/me",
             headers=headers
         )
@@ -330,7 +826,7 @@ async def get_asana_tasks(asana_token: Optional[str] = Header(None)):
     
     async with httpx.AsyncClient() as client:
         # Först hämta user ID
-        user_response = await client.get(
+        user_response = await upstream_get(client,
             "https://app.asana.com/api/1.0/users/me",
             headers=headers
         )
@@ -342,7 +838,7 @@ async def get_asana_tasks(asana_token: Optional[str] = Header(None)):
         user_gid = user_data["gid"]
         workspace_gid = user_data["workspaces"][0]["gid"]  # Hämta första workspace
 
-        tasks_response = await client.get(
+        tasks_response = await upstream_get(client,
             "https://app.asana.com/api/1.0/tasks",
             headers=headers,
             params={
@@ -571,7 +1067,7 @@ async def get_branches(owner: str, repo: str, authorization: Optional[str] = Hea
     
     async with httpx.AsyncClient() as client:
         # Hämta alla branches
-        response = await client.get(
+        response = await upstream_get(client,
             f"https://api.github.com/repos/{owner}/{repo}/branches",
             headers=headers,
             params={"per_page": 100}
@@ -606,31 +1102,36 @@ async def get_commits_graph(
         params["until"] = until
     
     async with httpx.AsyncClient() as client:
-        response = await client.get(
-            f"https://api.github.com/repos/{owner}/{repo}/commits",
-            headers=headers,
-            params=params
-        )
-        
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, detail="Kunde inte hämta commits")
-        
-        commits = response.json()
-        
-        # Berika med parent information
-        enriched_commits = []
-        for commit in commits:
-            enriched_commit = {
-                "sha": commit["sha"],
-                "message": commit["commit"]["message"],
-                "author": commit["commit"]["author"]["name"],
-                "date": commit["commit"]["author"]["date"],
-                "parents": [p["sha"] for p in commit["parents"]],
-                "html_url": commit["html_url"]
-            }
-            enriched_commits.append(enriched_commit)
-        
-        return enriched_commits
+        return await fetch_commit_graph(client, owner, repo, headers, params)
+
+async def fetch_commit_graph(client: httpx.AsyncClient, owner: str, repo: str, headers: Dict, params: Dict) -> List[Dict]:
+    """Hämta commits från GitHub och berika med parent information"""
+    response = await upstream_get(client,
+        f"https://api.github.com/repos/{owner}/{repo}/commits",
+        headers=headers,
+        params=params
+    )
+    
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail="Kunde inte hämta commits")
+    
+    commits = response.json()
+    
+    # Berika med parent information
+    enriched_commits = []
+    for commit in commits:
+        index_commit(f"{owner}/{repo}", commit, headers["Authorization"])
+        enriched_commit = {
+            "sha": commit["sha"],
+            "message": commit["commit"]["message"],
+            "author": commit["commit"]["author"]["name"],
+            "date": commit["commit"]["author"]["date"],
+            "parents": [p["sha"] for p in commit["parents"]],
+            "html_url": commit["html_url"]
+        }
+        enriched_commits.append(enriched_commit)
+    
+    return enriched_commits
 
 @app.get("/api/repos/{owner}/{repo}/default-branch")
 async def get_default_branch(owner: str, repo: str, authorization: Optional[str] = Header(None)):
@@ -644,7 +1145,7 @@ async def get_default_branch(owner: str, repo: str, authorization: Optional[str]
     }
     
     async with httpx.AsyncClient() as client:
-        response = await client.get(
+        response = await upstream_get(client,
             f"https://api.github.com/repos/{owner}/{repo}",
             headers=headers
         )
@@ -655,6 +1156,175 @@ async def get_default_branch(owner: str, repo: str, authorization: Optional[str]
         repo_data = response.json()
         return {"default_branch": repo_data["default_branch"]}
 
+# Cache för ahead/behind per (head SHA, base SHA). Bara kompletta resultat cachas, ofullständiga beror på
+# vilka historikfönster som råkade hämtas och kan bli bättre vid nästa anrop.
+DIVERGENCE_CACHE: Dict[tuple, Dict] = {}
+DIVERGENCE_CACHE_MAX = 5000
+DIVERGENCE_FETCH_CONCURRENCY = 4  # Max samtidiga historikhämtningar mot GitHub per request
+
+class CommitDag:
+    """Commit-graf med heltalsindex i topologisk ordning (föräldrar före barn)"""
+
+    def __init__(self, commits: List[Dict]):
+        parents_by_sha = {}
+        for commit in commits:
+            parents_by_sha.setdefault(commit["sha"], commit["parents"])
+
+        # Kahns algoritm så att varje förälder får lägre index än sina barn
+        children: Dict[str, List[str]] = {sha: [] for sha in parents_by_sha}
+        pending = {}
+        for sha, parents in parents_by_sha.items():
+            known_parents = [p for p in parents if p in parents_by_sha]
+            pending[sha] = len(known_parents)
+            for parent in known_parents:
+                children[parent].append(sha)
+
+        order = [sha for sha, count in pending.items() if count == 0]
+        for sha in order:
+            for child in children[sha]:
+                pending[child] -= 1
+                if pending[child] == 0:
+                    order.append(child)
+
+        self.shas = order
+        self.index = {sha: i for i, sha in enumerate(order)}
+
+        # Kompakta förälderlistor (CSR): föräldrar till nod i ligger i parent_indices[parent_offsets[i]:parent_offsets[i + 1]]
+        self.parent_offsets = array("i", [0])
+        self.parent_indices = array("i")
+        # Noder vars föräldrar ligger utanför det hämtade fönstret
+        self.boundary = 0
+        for i, sha in enumerate(order):
+            for parent in parents_by_sha[sha]:
+                if parent in self.index:
+                    self.parent_indices.append(self.index[parent])
+                else:
+                    self.boundary |= 1 << i
+            self.parent_offsets.append(len(self.parent_indices))
+
+        # Förfäder som bitset (Python int), nod i sätter bit i
+        self.ancestors: List[int] = []
+        for i in range(len(order)):
+            reach = 1 << i
+            for parent in self.parent_indices[self.parent_offsets[i]:self.parent_offsets[i + 1]]:
+                reach |= self.ancestors[parent]
+            self.ancestors.append(reach)
+
+    def __contains__(self, sha: str) -> bool:
+        return sha in self.index
+
+    def divergence(self, head_sha: str, base_sha: str) -> Dict:
+        """Räkna ut ahead/behind och merge-base mellan två commits"""
+        head_reach = self.ancestors[self.index[head_sha]]
+        base_reach = self.ancestors[self.index[base_sha]]
+        common = head_reach & base_reach
+        only_head = head_reach & ~base_reach
+        only_base = base_reach & ~head_reach
+
+        # Högsta index bland gemensamma förfäder kan inte vara förfader till någon annan gemensam förfader
+        merge_base = self.shas[common.bit_length() - 1] if common else None
+
+        return {
+            "ahead_by": bin(only_head).count("1"),
+            "behind_by": bin(only_base).count("1"),
+            "merge_base": merge_base,
+            # Om historiken klipptes av innan vi hittade merge-base blir siffrorna bara en nedre gräns
+            "complete": bool(common) and not (only_head | only_base) & self.boundary
+        }
+
+@app.get("/api/repos/{owner}/{repo}/branches/divergence")
+async def get_branches_divergence(
+    owner: str,
+    repo: str,
+    authorization: Optional[str] = Header(None),
+    base: Optional[str] = None
+):
+    """Hämta ahead/behind och merge-base mot default branch för alla branches"""
+    if not authorization:
+        raise HTTPException(status_code=401, detail="GitHub token saknas")
+
+    headers = {
+        "Authorization": authorization,
+        "Accept": "application/vnd.github.v3+json"
+    }
+
+    async with httpx.AsyncClient() as client:
+        if not base:
+            repo_response = await upstream_get(client,
+                f"https://api.github.com/repos/{owner}/{repo}",
+                headers=headers
+            )
+
+            if repo_response.status_code != 200:
+                raise HTTPException(status_code=repo_response.status_code, detail="Kunde inte hämta repo info")
+
+            base = repo_response.json()["default_branch"]
+
+        branches_response = await upstream_get(client,
+            f"https://api.github.com/repos/{owner}/{repo}/branches",
+            headers=headers,
+            params={"per_page": 100}
+        )
+
+        if branches_response.status_code != 200:
+            raise HTTPException(status_code=branches_response.status_code, detail="Kunde inte hämta branches")
+
+        branches = branches_response.json()
+        heads = {branch["name"]: branch["commit"]["sha"] for branch in branches}
+        if base not in heads:
+            raise HTTPException(status_code=404, detail="Base branch hittades inte")
+
+        base_sha = heads[base]
+        results = {sha: DIVERGENCE_CACHE[(sha, base_sha)] for sha in heads.values() if (sha, base_sha) in DIVERGENCE_CACHE}
+        uncached = {name: sha for name, sha in heads.items() if sha not in results}
+
+        if uncached:
+            # Bygg grafen från base-historiken och hämta bara historik för branches vars head inte redan finns i den
+            commits = await fetch_commit_graph(client, owner, repo, headers, {"sha": base_sha, "per_page": 100})
+            known = {commit["sha"] for commit in commits}
+            missing_heads = sorted({sha for sha in uncached.values() if sha not in known})
+            semaphore = asyncio.Semaphore(DIVERGENCE_FETCH_CONCURRENCY)
+
+            async def fetch_branch_history(sha: str) -> List[Dict]:
+                async with semaphore:
+                    return await fetch_commit_graph(client, owner, repo, headers, {"sha": sha, "per_page": 100})
+
+            branch_histories = await asyncio.gather(
+                *[fetch_branch_history(sha) for sha in missing_heads],
+                return_exceptions=True
+            )
+            for sha, history in zip(missing_heads, branch_histories):
+                # CancelledError (och andra BaseExceptions) ska avbryta hela requesten, inte bli ett branch-fel
+                if isinstance(history, BaseException) and not isinstance(history, Exception):
+                    raise history
+                if isinstance(history, Exception):
+                    # En branch som inte gick att hämta ska inte fälla hela svaret, och cachas inte
+                    error = history.detail if isinstance(history, HTTPException) else str(history)
+                    print(f"Kunde inte hämta historik för {sha}: {error}")
+                    results[sha] = {"ahead_by": None, "behind_by": None, "merge_base": None, "complete": False, "error": error}
+                else:
+                    commits.extend(history)
+
+            dag = CommitDag(commits)
+            for sha in set(uncached.values()):
+                if sha in results:
+                    continue
+                results[sha] = dag.divergence(sha, base_sha)
+                if not results[sha]["complete"]:
+                    continue
+                if len(DIVERGENCE_CACHE) >= DIVERGENCE_CACHE_MAX:
+                    DIVERGENCE_CACHE.pop(next(iter(DIVERGENCE_CACHE)))
+                DIVERGENCE_CACHE[(sha, base_sha)] = results[sha]
+
+    return {
+        "base_branch": base,
+        "base_sha": base_sha,
+        "branches": [
+            {"name": name, "sha": sha, **results[sha]}
+            for name, sha in heads.items()
+        ]
+    }
+
 @app.get("/api/repos/{owner}/{repo}/pulls/{pull_number}/commits-detailed")
 async def get_pr_commits_detailed(
     owner: str, 
@@ -673,7 +1343,7 @@ async def get_pr_commits_detailed(
     
     async with httpx.AsyncClient() as client:
         # Hämta PR info
-        pr_response = await client.get(
+        pr_response = await upstream_get(client,
             f"https://api.github.com/repos/{owner}/{repo}/pulls/{pull_number}",
             headers=headers
         )
@@ -684,7 +1354,7 @@ async def get_pr_commits_detailed(
         pr_data = pr_response.json()
         
         # Hämta alla commits för PR:en
-        commits_response = await client.get(
+        commits_response = await upstream_get(client,
             f"https://api.github.com/repos/{owner}/{repo}/pulls/{pull_number}/commits",
             headers=headers,
             params={"per_page": 250}  # Hämta alla commits
@@ -694,6 +1364,9 @@ async def get_pr_commits_detailed(
             raise HTTPException(status_code=commits_response.status_code, detail="Kunde inte hämta commits")
         
         commits = commits_response.json()
+        index_pull_request(f"{owner}/{repo}", pr_data, authorization)
+        for commit in commits:
+            index_commit(f"{owner}/{repo}", commit, authorization)
         
         # Första commit är branch creation point
         branch_created_at = commits[0]["commit"]["author"]["date"] if commits else None
@@ -710,6 +1383,32 @@ async def get_pr_commits_detailed(
             "last_commit": commits[-1] if commits else None
         }
 
+@app.get("/api/search")
+async def search(
+    q: str,
+    authorization: Optional[str] = Header(None),
+    author: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    repo: Optional[str] = None,
+    limit: int = 20
+):
+    """Sök bland indexerade PRs och commits som hämtats med samma GitHub token"""
+    if not authorization:
+        raise HTTPException(status_code=401, detail="GitHub token saknas")
+    
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Sökfråga saknas")
+
+    schedule_search_backfill(authorization)
+
+    results = search_index(q, authorization, author=author, since=since, until=until, repo=repo, limit=max(1, min(limit, 100)))
+    return {
+        "query": q,
+        "total_documents": sum(1 for doc in SEARCH_DOCS.values() if token_fingerprint(authorization) in doc["tokens"]),
+        "results": results
+    }
+
 @app.get("/api/health")
 async def health_check():
     """Hälsokontroll"""
@@ -0,0 +1,459 @@
+import asyncio
+import concurrent.futures
+import time
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import main
+
+URL = "https://api.github.com/repos/o/r"
+HOST = "api.github.com"
+
+
+@pytest.fixture(autouse=True)
+def reset_resilience_state(monkeypatch):
+    main.circuit_breakers.clear()
+    main.last_known_good.clear()
+    monkeypatch.setattr(main, "UPSTREAM_HEDGE_DELAY", 0)
+    monkeypatch.setattr(main.random, "uniform", lambda a, b: 0)
+
+
+def make_client(handler):
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def run_upstream_get(handler, budget_seconds=5.0):
+    async def call():
+        main.request_budget.set({"deadline": time.monotonic() + budget_seconds, "stale": False})
+        async with make_client(handler) as client:
+            return await main.upstream_get(client, URL, headers={"Authorization": "token t"})
+    return asyncio.run(call())
+
+
+def half_open_breaker():
+    main.circuit_breakers[HOST] = {
+        "failures": main.BREAKER_FAILURE_THRESHOLD,
+        "opened_at": time.monotonic() - main.BREAKER_OPEN_SECONDS - 1,
+        "probing": False
+    }
+
+
+def test_breaker_opens_after_repeated_failures():
+    def handler(request):
+        return httpx.Response(502)
+
+    for _ in range(main.BREAKER_FAILURE_THRESHOLD):
+        main.record_upstream_result(HOST, False)
+
+    assert main.circuit_breakers[HOST]["opened_at"] is not None
+    with pytest.raises(HTTPException) as error:
+        run_upstream_get(handler)
+    assert error.value.status_code == 503
+
+
+def test_half_open_allows_single_probe():
+    half_open_breaker()
+
+    assert main.breaker_allows(HOST)
+    assert not main.breaker_allows(HOST)
+
+
+def test_successful_probe_closes_breaker():
+    half_open_breaker()
+
+    response = run_upstream_get(lambda request: httpx.Response(200, json={}))
+
+    assert response.status_code == 200
+    assert main.circuit_breakers[HOST] == {"failures": 0, "opened_at": None, "probing": False}
+
+
+def test_failed_probe_reopens_breaker():
+    half_open_breaker()
+
+    response = run_upstream_get(lambda request: httpx.Response(502))
+
+    breaker = main.circuit_breakers[HOST]
+    assert response.status_code == 502
+    assert not breaker["probing"]
+    assert time.monotonic() - breaker["opened_at"] < main.BREAKER_OPEN_SECONDS
+
+
+def test_spent_budget_does_not_take_probe():
+    half_open_breaker()
+
+    with pytest.raises(HTTPException) as error:
+        run_upstream_get(lambda request: httpx.Response(200, json={}), budget_seconds=-1)
+
+    assert error.value.status_code == 504
+    assert not main.circuit_breakers[HOST]["probing"]
+    assert main.breaker_allows(HOST)
+
+
+def test_cancelled_probe_is_released():
+    half_open_breaker()
+
+    async def handler(request):
+        await asyncio.sleep(10)
+        return httpx.Response(200, json={})
+
+    async def call():
+        main.request_budget.set({"deadline": time.monotonic() + 5, "stale": False})
+        async with make_client(handler) as client:
+            task = asyncio.create_task(main.upstream_get(client, URL))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    asyncio.run(call())
+
+    assert not main.circuit_breakers[HOST]["probing"]
+    assert main.breaker_allows(HOST)
+
+
+def test_attempt_timeout_is_wall_clock(monkeypatch):
+    monkeypatch.setattr(main, "UPSTREAM_ATTEMPT_TIMEOUT", 0.1)
+    monkeypatch.setattr(main, "UPSTREAM_MAX_RETRIES", 0)
+
+    async def handler(request):
+        await asyncio.sleep(1)
+        return httpx.Response(200, json={})
+
+    started = time.monotonic()
+    with pytest.raises(HTTPException) as error:
+        run_upstream_get(handler)
+
+    assert error.value.status_code == 504
+    assert time.monotonic() - started < 0.5
+
+
+def test_hedge_ignores_retryable_first_response(monkeypatch):
+    monkeypatch.setattr(main, "UPSTREAM_HEDGE_DELAY", 0.05)
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            await asyncio.sleep(0.1)
+            return httpx.Response(502)
+        await asyncio.sleep(0.2)
+        return httpx.Response(200, json={"ok": True})
+
+    response = run_upstream_get(handler)
+
+    assert response.status_code == 200
+    assert len(calls) == 2
+
+
+def test_stale_cache_served_while_breaker_open():
+    run_upstream_get(lambda request: httpx.Response(200, json={"cached": True}))
+    main.circuit_breakers[HOST] = {"failures": 5, "opened_at": time.monotonic(), "probing": False}
+
+    async def call():
+        budget = {"deadline": time.monotonic() + 5, "stale": False}
+        main.request_budget.set(budget)
+        async with make_client(lambda request: httpx.Response(500)) as client:
+            response = await main.upstream_get(client, URL, headers={"Authorization": "token t"})
+        return response, budget
+
+    response, budget = asyncio.run(call())
+
+    assert response.json() == {"cached": True}
+    assert budget["stale"]
+
+
+@pytest.fixture
+def empty_search_index(monkeypatch):
+    monkeypatch.setattr(main, "SEARCH_DOCS", {})
+    monkeypatch.setattr(main, "SEARCH_POSTINGS", {})
+    monkeypatch.setattr(main, "SEARCH_TOTAL_LENGTH", 0)
+
+
+def make_commit(sha, message, author="Kalle", login="kalle", date="2024-03-10T10:00:00Z", parents=()):
+    return {
+        "sha": sha,
+        "commit": {"message": message, "author": {"name": author, "date": date}},
+        "author": {"login": login},
+        "parents": [{"sha": parent} for parent in parents],
+        "html_url": f"https://github.com/o/r/commit/{sha}"
+    }
+
+
+@pytest.mark.parametrize("words", [
+    ["release", "released", "releases", "releasing"],
+    ["date", "dates", "dated"],
+    ["case", "cases"],
+    ["class", "classes"],
+    ["fix", "fixa", "fixat", "fixade", "fixed", "fixes", "fixing"],
+    ["förbättring", "förbättringar", "forbattringen"],
+    ["bugg", "buggen", "buggar", "buggarna"],
+    ["uppdatera", "uppdaterad", "uppdaterat", "uppdatering"],
+    ["user", "users"],
+    ["query", "queries"],
+])
+def test_normalize_search_term_stem_equivalence(words):
+    assert len({main.normalize_search_term(word) for word in words}) == 1
+
+
+def test_search_matches_inflected_forms(empty_search_index):
+    main.index_commit("o/r", make_commit("a1", "Released version 2"), "token A")
+    main.index_commit("o/r", make_commit("a2", "Fixa onboarding-buggen"), "token A")
+
+    assert [hit["sha"] for hit in main.search_index("release", "token A")] == ["a1"]
+    assert [hit["sha"] for hit in main.search_index("fix", "token A")] == ["a2"]
+    assert [hit["sha"] for hit in main.search_index("Onboarding", "token A")] == ["a2"]
+
+
+def test_search_filters_by_author_date_and_repo(empty_search_index):
+    main.index_commit("o/r", make_commit("a1", "onboarding fix", author="Kalle", login="kalle", date="2024-03-10T10:00:00Z"), "token A")
+    main.index_commit("o/r", make_commit("a2", "onboarding fix", author="Eva", login="eva", date="2024-04-02T10:00:00Z"), "token A")
+    main.index_commit("o/other", make_commit("a3", "onboarding fix", date="2024-03-31T22:00:00Z"), "token A")
+
+    def shas(**filters):
+        return sorted(hit["sha"] for hit in main.search_index("onboarding", "token A", **filters))
+
+    assert shas(author="EVA") == ["a2"]
+    assert shas(author="Kalle") == ["a1", "a3"]
+    assert shas(since="2024-04-01") == ["a2"]
+    assert shas(until="2024-03-31") == ["a1", "a3"]
+    assert shas(repo="O/R") == ["a1", "a2"]
+
+
+def test_search_is_scoped_to_token(empty_search_index):
+    main.index_pull_request("o/private", {"number": 1, "title": "Secret onboarding", "user": {"login": "kalle"}}, "token A")
+    main.index_commit("o/public", make_commit("a1", "onboarding fix"), "token B")
+    main.index_commit("o/public", make_commit("a1", "onboarding fix"), "token A")
+
+    assert [hit["sha"] for hit in main.search_index("onboarding", "token B")] == ["a1"]
+    assert len(main.search_index("onboarding", "token A")) == 2
+    assert main.search_index("onboarding", "token C") == []
+
+
+def test_search_endpoint_requires_token(empty_search_index):
+    from fastapi.testclient import TestClient
+
+    main.index_pull_request("o/private", {"number": 1, "title": "Secret onboarding"}, "token A")
+    client = TestClient(main.app)
+
+    assert client.get("/api/search", params={"q": "onboarding"}).status_code == 401
+    response = client.get("/api/search", params={"q": "onboarding"}, headers={"Authorization": "token B"})
+    assert response.json()["results"] == []
+    assert response.json()["total_documents"] == 0
+
+
+def test_search_index_survives_restart(empty_search_index, monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "SEARCH_INDEX_FILE", str(tmp_path / "search_index.json"))
+    main.index_commit("o/r", make_commit("a1", "Released version 2"), "token A")
+    main.save_search_index()
+
+    monkeypatch.setattr(main, "SEARCH_DOCS", {})
+    monkeypatch.setattr(main, "SEARCH_POSTINGS", {})
+    monkeypatch.setattr(main, "SEARCH_TOTAL_LENGTH", 0)
+    main.load_search_index()
+
+    hits = main.search_index("release", "token A")
+    assert [hit["sha"] for hit in hits] == ["a1"]
+    assert "text" not in hits[0]
+    assert main.search_index("release", "token B") == []
+
+
+def test_backfill_indexes_all_saved_repos(empty_search_index, monkeypatch, tmp_path):
+    repos_file = tmp_path / "saved_repos.json"
+    repos_file.write_text('["https://github.com/o/r"]')
+    monkeypatch.setattr(main, "REPOS_FILE", str(repos_file))
+    monkeypatch.setattr(main, "SEARCH_INDEX_FILE", str(tmp_path / "search_index.json"))
+    monkeypatch.setattr(main, "search_backfilled", {})
+
+    def handler(request):
+        if request.url.params["page"] != "1":
+            return httpx.Response(200, json=[])
+        if request.url.path.endswith("/pulls"):
+            return httpx.Response(200, json=[{"number": 7, "title": "Onboarding i mars", "user": {"login": "kalle"}}])
+        return httpx.Response(200, json=[make_commit("a1", "Fixa onboarding-buggen")])
+
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(main.httpx, "AsyncClient", lambda: real_client(transport=httpx.MockTransport(handler)))
+
+    async def call():
+        main.schedule_search_backfill("token A")
+        await asyncio.gather(*main.search_backfill_tasks)
+
+    asyncio.run(call())
+
+    assert {hit["type"] for hit in main.search_index("onboarding", "token A")} == {"pull_request", "commit"}
+    assert (tmp_path / "search_index.json").exists()
+
+
+def dag_commit(sha, *parents):
+    return {"sha": sha, "parents": list(parents)}
+
+
+# root <- a <- b <- m (merge av b och f2), feature: a <- f1 <- f2, other: b <- o1
+DAG_COMMITS = [
+    dag_commit("m", "b", "f2"),
+    dag_commit("b", "a"),
+    dag_commit("a", "root"),
+    dag_commit("root"),
+    dag_commit("f2", "f1"),
+    dag_commit("f1", "a"),
+    dag_commit("o1", "b"),
+]
+
+
+def test_divergence_fork():
+    dag = main.CommitDag(DAG_COMMITS)
+
+    assert dag.divergence("f2", "b") == {"ahead_by": 2, "behind_by": 1, "merge_base": "a", "complete": True}
+
+
+def test_divergence_merge_commit():
+    dag = main.CommitDag(DAG_COMMITS)
+
+    assert dag.divergence("o1", "m") == {"ahead_by": 1, "behind_by": 3, "merge_base": "b", "complete": True}
+    assert dag.divergence("m", "o1") == {"ahead_by": 3, "behind_by": 1, "merge_base": "b", "complete": True}
+
+
+def test_divergence_head_is_ancestor_of_base():
+    dag = main.CommitDag(DAG_COMMITS)
+
+    assert dag.divergence("f2", "m") == {"ahead_by": 0, "behind_by": 2, "merge_base": "f2", "complete": True}
+    assert dag.divergence("m", "m") == {"ahead_by": 0, "behind_by": 0, "merge_base": "m", "complete": True}
+
+
+def test_divergence_truncated_window_is_incomplete():
+    # Historikfönstret slutar innan branchen och base möts
+    dag = main.CommitDag([
+        dag_commit("base2", "base1"),
+        dag_commit("base1", "outside"),
+        dag_commit("f1", "outside2"),
+    ])
+
+    result = dag.divergence("f1", "base2")
+    assert result["merge_base"] is None
+    assert not result["complete"]
+    assert (result["ahead_by"], result["behind_by"]) == (1, 2)
+
+
+def run_divergence(handler, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(main.httpx, "AsyncClient", lambda: real_client(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(main, "UPSTREAM_MAX_RETRIES", 0)
+    response = TestClient(main.app).get("/api/repos/o/r/branches/divergence?base=main", headers={"Authorization": "token A"})
+    assert response.status_code == 200
+    return {branch["name"]: branch for branch in response.json()["branches"]}
+
+
+def commits_response(*commits):
+    return httpx.Response(200, json=[make_commit(sha, sha, parents=parents) for sha, *parents in commits])
+
+
+def test_divergence_endpoint_caches_only_complete_results(monkeypatch):
+    monkeypatch.setattr(main, "DIVERGENCE_CACHE", {})
+
+    def handler(request):
+        if request.url.path.endswith("/repos/o/r"):
+            return httpx.Response(200, json={"default_branch": "main"})
+        if request.url.path.endswith("/branches"):
+            return httpx.Response(200, json=[
+                {"name": "main", "commit": {"sha": "m"}},
+                {"name": "feature", "commit": {"sha": "f1"}},
+                {"name": "old", "commit": {"sha": "x1"}},
+                {"name": "broken", "commit": {"sha": "bad"}},
+            ])
+        sha = request.url.params["sha"]
+        if sha == "m":
+            return commits_response(("m", "a"), ("a", "root"), ("root",))
+        if sha == "f1":
+            return commits_response(("f1", "a"), ("a", "root"), ("root",))
+        if sha == "x1":
+            return commits_response(("x1", "outside"))
+        return httpx.Response(404)
+
+    branches = run_divergence(handler, monkeypatch)
+
+    assert branches["feature"]["ahead_by"] == 1 and branches["feature"]["complete"]
+    assert not branches["old"]["complete"]
+    assert not branches["broken"]["complete"] and branches["broken"]["error"]
+    assert set(main.DIVERGENCE_CACHE) == {("m", "m"), ("f1", "m")}
+
+
+def test_divergence_endpoint_propagates_cancellation(monkeypatch):
+    monkeypatch.setattr(main, "DIVERGENCE_CACHE", {})
+
+    def handler(request):
+        if request.url.path.endswith("/branches"):
+            return httpx.Response(200, json=[
+                {"name": "main", "commit": {"sha": "m"}},
+                {"name": "feature", "commit": {"sha": "f1"}},
+            ])
+        if request.url.params["sha"] == "m":
+            return commits_response(("m",))
+        raise asyncio.CancelledError()
+
+    # TestClient kör appen i en annan tråd och översätter avbrottet till concurrent.futures.CancelledError
+    with pytest.raises((asyncio.CancelledError, concurrent.futures.CancelledError)):
+        run_divergence(handler, monkeypatch)
+
+
+def test_rate_limit_does_not_open_breaker():
+    for _ in range(main.BREAKER_FAILURE_THRESHOLD):
+        response = run_upstream_get(lambda request: httpx.Response(429))
+        assert response.status_code == 429
+
+    assert main.circuit_breakers.get(HOST, {}).get("failures", 0) == 0
+    assert main.breaker_allows(HOST)
+
+
+def test_breaker_records_one_failure_per_call():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(502)
+
+    run_upstream_get(handler)
+    run_upstream_get(handler)
+
+    assert len(calls) == 2 * (main.UPSTREAM_MAX_RETRIES + 1)
+    assert main.circuit_breakers[HOST]["failures"] == 2
+    assert main.circuit_breakers[HOST]["opened_at"] is None
+
+
+def test_other_call_does_not_release_probe():
+    half_open_breaker()
+    assert main.breaker_allows(HOST)
+
+    main.record_upstream_result(HOST, False)
+
+    assert main.circuit_breakers[HOST]["probing"]
+    assert not main.breaker_allows(HOST)
+
+
+def test_hedge_delay_cancellation_cancels_request(monkeypatch):
+    monkeypatch.setattr(main, "UPSTREAM_HEDGE_DELAY", 1)
+    cancelled = []
+
+    async def handler(request):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(request)
+            raise
+        return httpx.Response(200, json={})
+
+    async def call():
+        async with make_client(handler) as client:
+            task = asyncio.create_task(main.hedged_get(client, URL, 5))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0.01)
+            # Måste kollas innan asyncio.run städar bort kvarvarande tasks
+            assert len(cancelled) == 1
+
+    asyncio.run(call())